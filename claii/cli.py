@@ -2,117 +2,202 @@
 Claii (Command Line AI Interface) CLI/REPL
 """
 import os
+import io
 import sys
 import cmd
 import subprocess
 import sqlite3
-from typing import Any
-from collections import namedtuple
+import functools
+import contextlib
+from typing import Optional
 
 import click
-import chromadb
-from chromadb.config import Settings as ChromaSettings
-import openai
-import openai.error
-from dotenv import load_dotenv
-
-load_dotenv()
-openai.api_key = os.getenv('OPENAI_API_KEY')
 
 HOME_PATH = os.path.expanduser('~')
 CLAI_SAVE_PATH = os.path.join(HOME_PATH, '.local', 'claii')
-if not os.path.exists(CLAI_SAVE_PATH):
-    os.makedirs(CLAI_SAVE_PATH)
-SQLDB = sqlite3.connect(os.path.join(CLAI_SAVE_PATH, 'claii.db'))
-chroma_setting = ChromaSettings(
-    persist_directory=os.path.join(CLAI_SAVE_PATH, 'chroma')
+os.makedirs(CLAI_SAVE_PATH, exist_ok=True)
+# WAL mode keeps claii.db-wal and claii.db-shm files alongside claii.db
+SQLDB = sqlite3.connect(
+    os.path.join(CLAI_SAVE_PATH, 'claii.db'),
+    check_same_thread=False,
+    isolation_level=None,
+    cached_statements=256,
 )
-CHROMA_CLIENT = chromadb.Client(chroma_setting)
+SQLDB.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-32000;
+""")
+SQLDB.execute('PRAGMA busy_timeout=5000')
+SQLDB.row_factory = sqlite3.Row
+
+# SQL text is kept in constants so the connection's statement cache key is
+# stable across calls
+_SQL_INSERT_MSG = """
+    INSERT INTO chat_messages (sid, role, content) VALUES (?, ?, ?)
+"""
+_SQL_INSERT_SESSION = """
+    INSERT INTO chat_sessions (title, model, provider) VALUES (?, ?, ?)
+"""
+_SQL_UPDATE_TITLE = """
+    UPDATE chat_sessions SET title = ? WHERE id = ?
+"""
+_SQL_SELECT_SESSION_CHAT = """
+    SELECT s.title, m.role, m.content FROM chat_sessions s
+    LEFT JOIN chat_messages m ON m.sid = s.id
+    WHERE s.id = ? ORDER BY m.timestamp ASC, m.id ASC
+"""
+_SQL_SELECT_SESSIONS = """
+    SELECT id, title, updated FROM chat_sessions ORDER BY updated ASC
+"""
+_SQL_SESSION_EXISTS = 'SELECT 1 FROM chat_sessions WHERE id = ? LIMIT 1'
+_SQL_SELECT_SESSION_MSGS = """
+    SELECT role, content, timestamp FROM chat_messages
+    WHERE sid = ? ORDER BY timestamp ASC
+"""
 
 
-def dict_factory(cursor, row):
-    fields = [column[0] for column in cursor.description]
-    return dict(zip(fields, row))
+@functools.cache
+def get_openai():
+    """Import openai on first use and load OPENAI_API_KEY (also from .env)"""
+    from dotenv import load_dotenv
+    import requests
+    from requests.adapters import HTTPAdapter
+    import openai
+    import openai.error
 
+    load_dotenv()
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+    # share one pooled session so later chat turns reuse the TLS connection
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    openai.requestssession = session
+    return openai
 
-def namedtuple_factory(cursor, row):
-    fields = [column[0] for column in cursor.description]
-    cls = namedtuple('Row', fields)
-    return cls._make(row)
 
+@functools.cache
+def get_chroma_client():
+    """Create the persistent chromadb client on first use"""
+    import chromadb
+    from chromadb.config import Settings as ChromaSettings
 
-SQLDB.row_factory = dict_factory
+    chroma_setting = ChromaSettings(
+        persist_directory=os.path.join(CLAI_SAVE_PATH, 'chroma')
+    )
+    return chromadb.Client(chroma_setting)
 
 
-def get_history(sid):
-    res = SQLDB.execute("""
-        SELECT role, content FROM chat_messages WHERE sid = ? ORDER BY timestamp ASC
-    """, (sid,))
-    return list(res)
+def _commit() -> None:
+    """Commit the transaction opened by the caller with BEGIN"""
+    SQLDB.execute('COMMIT')
+
+
+@contextlib.contextmanager
+def _write_transaction():
+    """Run the enclosed writes in one transaction, rolled back on error
+
+    BEGIN IMMEDIATE takes the write lock up front (waiting out busy_timeout)
+    so a read inside the transaction can't fail to upgrade to a write.
+    """
+    SQLDB.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+        _commit()
+    except BaseException:
+        # sqlite may already have rolled back (e.g. SQLITE_FULL, IOERR)
+        if SQLDB.in_transaction:
+            SQLDB.execute('ROLLBACK')
+        raise
 
 
 def save_history(sid, role, content):
-    SQLDB.execute("""
-        INSERT INTO chat_messages (sid, role, content) VALUES (?, ?, ?)
-    """, (sid, role, content))
-    SQLDB.commit()
+    SQLDB.execute(_SQL_INSERT_MSG, (sid, role, content))
 
 
 def new_sid(title) -> int:
-    sid = SQLDB.execute("""
-        INSERT INTO chat_sessions (title, model, provider) VALUES (?, ?, ?)
-    """, (title, 'gpt-3.5-turbo', 'openai'))
-    SQLDB.commit()
+    sid = SQLDB.execute(_SQL_INSERT_SESSION,
+                        (title, 'gpt-3.5-turbo', 'openai'))
     return sid.lastrowid
 
 
 def set_session_title(sid, title) -> None:
-    SQLDB.execute("""
-        UPDATE chat_sessions SET title = ? WHERE id = ?
-    """, (title, sid))
-    SQLDB.commit()
+    SQLDB.execute(_SQL_UPDATE_TITLE, (title, sid))
 
 
-def chat(prompt, sid=None) -> int:
+def chat(prompt, sid=None) -> Optional[int]:
     """
     Chat/Instruct with a user prompt
     Initially use openai.ChatCompletion
     """
+    openai = get_openai()
     messages = []
     system_content = 'You are a helpful assistant.'
-    if sid:
-        res = SQLDB.execute("""
-            SELECT title FROM chat_sessions WHERE id = ?
-        """, (sid,))
-        session = res.fetchone()
-        if session['title'] == '':
-            set_session_title(sid, prompt[:50])
-        history = get_history(sid)
-        for entry in history:
-            messages.append(entry)
-    else:
-        sid = new_sid(prompt[:50])
-        history = []
-        messages.append({'role': 'system', 'content': system_content})
-
-    messages.append({'role': 'user', 'content': prompt})
-    save_history(sid, 'user', prompt)
+    with _write_transaction():
+        if sid:
+            # title and history in one query, title is repeated on every row
+            title = None
+            for row in SQLDB.execute(_SQL_SELECT_SESSION_CHAT, (sid,)):
+                title = row[0]
+                if row[1] is not None:
+                    messages.append({'role': row[1], 'content': row[2]})
+            if title is None:
+                # no such session, don't write orphan messages under its id
+                print(f'unknown session id: {sid}')
+                return None
+            if title == '':
+                set_session_title(sid, prompt[:50])
+            # keep the same prefix as the first turn so the server-side
+            # prompt cache can hit; sessions started with :sm store their
+            # own system message
+            if not messages or messages[0]['role'] != 'system':
+                messages.insert(
+                    0, {'role': 'system', 'content': system_content})
+        else:
+            sid = new_sid(prompt[:50])
+            history = []
+            messages.append({'role': 'system', 'content': system_content})
+
+        messages.append({'role': 'user', 'content': prompt})
+        save_history(sid, 'user', prompt)
 
     try:
-        response = []
+        response = io.StringIO()
         res_stream = openai.ChatCompletion.create(
             model='gpt-3.5-turbo',
             messages=messages,
             stream=True,
         )
-        for chunk in res_stream:
-            content = chunk['choices'][0].get('delta', {}).get('content')
-            if content:
-                response.append(content)
-                print(content, end='')
-                sys.stdout.flush()
+        _write = sys.stdout.write
+        _flush = sys.stdout.flush
+        # print tokens in batches of up to 8 tokens / 64 chars, or earlier
+        # at the end of a line or sentence
+        batch = []
+        batch_len = 0
+        try:
+            for chunk in res_stream:
+                delta = chunk['choices'][0].get('delta')
+                content = delta and delta.get('content')
+                if content:
+                    response.write(content)
+                    batch.append(content)
+                    batch_len += len(content)
+                    if (len(batch) >= 8 or batch_len >= 64
+                            or content.endswith(('\n', '.', '?', '!'))):
+                        _write(''.join(batch))
+                        _flush()
+                        batch.clear()
+                        batch_len = 0
+        finally:
+            # show every token received, even if the stream was interrupted
+            if batch:
+                _write(''.join(batch))
+                _flush()
         print()
-        save_history(sid, 'assistant', ''.join(response))
+        with _write_transaction():
+            save_history(sid, 'assistant', response.getvalue())
     except openai.error.OpenAIError as e:
         print(e)
 
@@ -131,54 +216,73 @@ def name(cmd_name):
     return decorator
 
 
+def collect_commands(cls):
+    """Class decorator to gather the @name'd methods into cls._CMD_MAP
+    """
+    cls._CMD_MAP = {}
+    for klass in reversed(cls.__mro__):
+        for attr, func in vars(klass).items():
+            if hasattr(func, 'cmd_name'):
+                cls._CMD_MAP[func.cmd_name] = attr
+    return cls
+
+
+@collect_commands
 class ClaiRepl(cmd.Cmd):
     """
     REPL class, inherits from cmd.Cmd
     """
     prompt = '>>> '
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # subclasses get their own map including any @name'd methods they add
+        collect_commands(cls)
+
     def __init__(self):
         super().__init__()
-        self.real_commands = {}
-        for fnname in dir(self):
-            func = getattr(self, fnname)
-            if hasattr(func, 'cmd_name'):
-                self.real_commands[func.cmd_name] = func
+        self.real_commands = {
+            cmd_name: getattr(self, attr)
+            for cmd_name, attr in type(self)._CMD_MAP.items()
+        }
+        self._cmd_names = tuple(sorted(self.real_commands))
 
         self.sid = None
-        self.chroma_client = None
         self.setup_local_dbs()
 
+    @property
+    def chroma_client(self):
+        """chromadb client, created on first access"""
+        return get_chroma_client()
+
     def setup_local_dbs(self) -> None:
-        cursor = SQLDB.cursor()
-        cursor.execute("""SELECT name FROM sqlite_master
-                       WHERE type='table' AND name='chat_messages'""")
-        if not cursor.fetchone():
-            cursor.execute("""
-                Create TABLE chat_sessions (
-                  id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  title TEXT NOT NULL,
-                  model TEXT NOT NULL,
-                  provider TEXT NOT NULL,
-                  updated DATETIME DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            cursor.execute("""
-               CREATE TABLE chat_messages (
-                  id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  sid integer NOT NULL references chat_sessions(id),
-                  role TEXT NOT NULL,
-                  content TEXT NOT NULL,
-                  timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-            SQLDB.commit()
+        SQLDB.executescript("""
+            BEGIN;
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              title TEXT NOT NULL,
+              model TEXT NOT NULL,
+              provider TEXT NOT NULL,
+              updated DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS chat_messages (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              sid integer NOT NULL references chat_sessions(id),
+              role TEXT NOT NULL,
+              content TEXT NOT NULL,
+              timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS idx_chat_messages_sid_ts
+              ON chat_messages(sid, timestamp);
+            COMMIT;
+        """)
 
     def default(self, line) -> None:
         command, _, arg = line.partition(' ')
-        if command in self.real_commands:
+        cmd_fn = self.real_commands.get(command)
+        if cmd_fn is not None:
             try:
-                self.real_commands[command](arg)
+                cmd_fn(arg)
             except Exception as e:
                 print(f'Error: {e}')
         else:
@@ -187,8 +291,8 @@ class ClaiRepl(cmd.Cmd):
     def emptyline(self):
         pass
 
-    def completedefault(self, *ignored: Any) -> list[str]:
-        return list(self.real_commands.keys())
+    def completedefault(self, *ignored) -> tuple[str, ...]:
+        return self._cmd_names
 
     def do_help(self, arg):
         arg = arg.strip()
@@ -220,11 +324,11 @@ class ClaiRepl(cmd.Cmd):
     @name(':ss')
     def list_sessions(self, arg):
         """list all chat sessions"""
-        res = SQLDB.execute("""
-            SELECT id, title, updated FROM chat_sessions ORDER BY updated ASC
-        """)
-        for row in res:
-            print(f'{row["id"]}: {row["title"]} ({row["updated"]})')
+        res = SQLDB.execute(_SQL_SELECT_SESSIONS)
+        # columns: id, title, updated
+        lines = [f'{row[0]}: {row[1]} ({row[2]})' for row in res]
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
 
     @name(':cs')
     def continue_session(self, arg):
@@ -235,10 +339,10 @@ class ClaiRepl(cmd.Cmd):
             print('please specify a session id')
             return
 
-        res = SQLDB.execute('SELECT id FROM chat_sessions')
-        ids = [row['id'] for row in res]
-        if sid not in ids:
+        exists = SQLDB.execute(_SQL_SESSION_EXISTS, (sid,)).fetchone()
+        if exists is None:
             print(f'unknown session id: {sid}')
+            return
         self.sid = sid
 
     @name(':sh')
@@ -248,18 +352,19 @@ class ClaiRepl(cmd.Cmd):
             print('no session selected')
             return
 
-        res = SQLDB.execute("""
-            SELECT role, content, timestamp FROM chat_messages
-            WHERE sid = ? ORDER BY timestamp ASC
-        """, (self.sid,))
-        for row in res:
-            print(f'{row["timestamp"]} {row["role"]}: {row["content"]}')
+        res = SQLDB.execute(_SQL_SELECT_SESSION_MSGS, (self.sid,))
+        # columns: role, content, timestamp
+        lines = [f'{row[2]} {row[0]}: {row[1]}' for row in res]
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
 
     @name(':sm')
     def system_message(self, arg):
         """set a system message"""
-        self.sid = new_sid('')
-        save_history(self.sid, 'system', arg)
+        with _write_transaction():
+            sid = new_sid('')
+            save_history(sid, 'system', arg)
+        self.sid = sid
 
 
 @click.group(invoke_without_command=True)
@@ -28,10 +28,11 @@ setuptools.setup(
     },
     install_requires=[
         'click',
-        'openai',
+        'openai<1.0',
+        'requests',
         'chromadb',
         'python-dotenv',
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.9',
     include_package_data=True,
 )